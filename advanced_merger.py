@@ -1,8 +1,10 @@
 import os
 import pandas as pd
+import numpy as np
 import json
 import re
 from datetime import datetime
+from functools import lru_cache
 from openpyxl import load_workbook
 from openpyxl.styles import Alignment, Font
 
@@ -61,7 +63,7 @@ def read_file(path):
     if path.startswith("http://") or path.startswith("https://"):
         df = pd.read_csv(path)
     elif path.endswith(".xlsx"):
-        df = pd.read_excel(path)
+        df = next(iter(read_xlsx(path, first_only=True).values()), pd.DataFrame())
     else:
         try:
             df = pd.read_csv(path, sep="\t", encoding="utf-16")
@@ -76,6 +78,83 @@ def read_file(path):
     )
     return df
 
+# ---------------- XLSX READ (STREAMING) ----------------
+def read_xlsx_sheet(ws, usecols=None):
+    """Stream one read-only worksheet row by row, keeping only the needed columns"""
+    # Exporters often write a stale <dimension> tag, which would cut rows/columns short
+    ws.reset_dimensions()
+    rows = ws.iter_rows(values_only=True)
+    # The first non-empty row is the header
+    header = next((row for row in rows if any(v is not None for v in row)), None)
+    if header is None:
+        return pd.DataFrame()
+    header = list(header)
+    while header[-1] is None:
+        header.pop()
+
+    # Name every column the way read_file would ("unnamed: N" for blanks, ".1" for repeats),
+    # then keep only the needed ones
+    keep = []
+    names = []
+    seen = {}
+    for i, h in enumerate(header):
+        name = "" if h is None else str(h).replace("\ufeff", "").strip().lower()
+        if not name:
+            name = f"unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        if usecols is None or name in usecols:
+            keep.append(i)
+            names.append(name)
+
+    data = []
+    for row in rows:
+        vals = [row[i] if i < len(row) else None for i in keep]
+        # Read-only sheets often report trailing empty rows
+        if any(v is not None for v in vals):
+            data.append(vals)
+
+    return pd.DataFrame(data, columns=names)
+
+def read_xlsx(path, usecols=None, ask_sheets=False, first_only=False):
+    """Open the workbook once and read its sheets, returns {sheet_name: DataFrame}"""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = wb.sheetnames
+        if first_only:
+            sheets = sheets[:1]
+        elif ask_sheets:
+            sheets = choose_xlsx_sheets(sheets)
+        return {sheet: read_xlsx_sheet(wb[sheet], usecols) for sheet in sheets}
+    finally:
+        wb.close()
+
+def choose_xlsx_sheets(sheets):
+    """Ask which sheets to read when a workbook has more than one"""
+    if len(sheets) <= 1:
+        return sheets
+    print(f"  Workbook has {len(sheets)} sheets:")
+    for i, sheet in enumerate(sheets, 1):
+        print(f"    {i}. {sheet}")
+    sel = input("  Sheet number(s) to read (comma-separated, ENTER for all): ").strip()
+    if not sel:
+        return sheets
+
+    chosen = []
+    for num in sel.split(","):
+        num = num.strip()
+        if num.isdigit() and 1 <= int(num) <= len(sheets):
+            chosen.append(sheets[int(num) - 1])
+        elif num:
+            print(f"  ⚠ Warning: Sheet number {num} not found, skipping")
+    if not chosen:
+        print("  ℹ No valid sheet selected, reading all sheets")
+        return sheets
+    return list(dict.fromkeys(chosen))
+
 # ---------------- FORMAT APPLY ----------------
 def apply_format(val, code):
     try:
@@ -109,6 +188,78 @@ def apply_format(val, code):
         return ""
     return val
 
+# ---------------- FORMAT CHAIN (UNIQUE VALUES) ----------------
+FORMAT_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=128)
+def chain_evaluator(chain, lookup, dict_items):
+    """Return a memoized per-value evaluator for one format chain + dictionary"""
+    col_dict = dict(dict_items)
+
+    # factorize_column keeps 1 / 1.0 / True apart; typed=True stops the memo merging them again
+    @lru_cache(maxsize=FORMAT_CACHE_SIZE, typed=True)
+    def evaluate(val):
+        """Apply format codes and dictionary lookup (k/q) to one value"""
+        for t in chain:
+            val = apply_format(val, t)
+
+        if lookup and col_dict:
+            matches = [v for k, v in col_dict.items() if k != "__default__" and k in str(val).lower()]
+            if matches:
+                val = ", ".join(dict.fromkeys(matches))
+            elif "q" in lookup and "__default__" in col_dict:
+                # Use default value if no match found
+                val = col_dict["__default__"]
+            elif "k" in lookup:
+                # For regular k, leave empty if no match
+                val = ""
+        return val
+
+    return evaluate
+
+def factorize_column(s):
+    """Factorize one column; object columns are keyed by (type, value) as str(1) != str(1.0)"""
+    if s.dtype != object:
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        return codes, list(uniques)
+
+    # Missing values (None/NaN) all read as nan, like row[col] did
+    vals = [np.nan if pd.isna(v) else v for v in s]
+    keys = pd.Series([None if v is np.nan else (type(v), v) for v in vals], dtype=object)
+    codes, _ = pd.factorize(keys, use_na_sentinel=False)
+    # Codes follow first appearance, so the first row of each code is its raw value
+    first = np.unique(codes, return_index=True)[1]
+    return codes, [vals[i] for i in first]
+
+def factorize_source(df, source):
+    """Return (codes, uniques) so that uniques[codes] gives the raw value of every row"""
+    blank = (np.zeros(len(df), dtype=np.intp), [""])
+
+    if source == "0":
+        return blank
+
+    if source.startswith("["):
+        # Multiple columns: factorize the combination, then join each distinct row
+        cols = [cn.strip() for cn in source.strip("[]").split(",")]
+        cols = [cn for cn in dict.fromkeys(cols) if cn in df.columns]
+        if not cols:
+            return blank
+        col_codes = pd.DataFrame({
+            i: factorize_column(df[cn])[0] for i, cn in enumerate(cols)
+        })
+        codes = col_codes.groupby(list(col_codes.columns), sort=False).ngroup().to_numpy()
+        first_rows = df[cols][~col_codes.duplicated().to_numpy()]
+        uniques = []
+        for row in first_rows.itertuples(index=False):
+            raw = [str(v).strip() for v in row if str(v).strip()]
+            uniques.append(" ".join(dict.fromkeys(raw)))
+        return codes, uniques
+
+    if source in df.columns:
+        return factorize_column(df[source])
+
+    return blank
+
 # ---------------- DICTIONARY INPUT ----------------
 def read_dictionary_inline():
     print("\nEnter dictionary mapping (ENTER key to stop)")
@@ -133,9 +284,46 @@ def read_dictionary_with_default():
         dk[key] = value
     return dk
 
+# ---------------- TEMPLATE COLUMNS ----------------
+def template_columns(template):
+    """Return the input column names a template reads, in order"""
+    cols = []
+    for rule in template:
+        tokens = rule[1:]
+        # Remove dict if present
+        if isinstance(tokens[-1], dict):
+            tokens = tokens[:-1]
+        # Remove alignment codes
+        tokens = [t for t in tokens if t not in ALIGN_CODES]
+
+        for token in tokens:
+            # Skip format codes and "0"
+            if token in FORMAT_CODES or token == "0":
+                continue
+            # Check if it's a column list
+            if token.startswith("[") and token.endswith("]"):
+                cols.extend(cn.strip() for cn in token.strip("[]").split(","))
+            # Single column
+            else:
+                cols.append(token)
+    return list(dict.fromkeys(cols))
+
 # ---------------- LOAD FILES FUNCTION ----------------
-def load_files():
-    """Load files based on user choice"""
+def xlsx_sources(path, sheet_dfs):
+    """Name each non-empty sheet as a separate source: 'file.xlsx [Sheet]'"""
+    base = os.path.basename(path)
+    sources = []
+    for sheet, df in sheet_dfs.items():
+        if len(df.columns):
+            sources.append((sheet, df))
+        else:
+            print(f"⚠ Skipped sheet '{sheet}' (no usable header/columns)")
+    if len(sheet_dfs) == 1:
+        return [(base, df) for _, df in sources]
+    return [(f"{base} [{sheet}]", df) for sheet, df in sources]
+
+def load_files(usecols=None):
+    """Load files based on user choice (usecols limits which xlsx columns are read)"""
     dfs = []
     file_names = []
     print("\nSelect input source:")
@@ -153,6 +341,15 @@ def load_files():
             if not path:
                 break
             try:
+                if path.endswith(".xlsx") and not path.startswith(("http://", "https://")):
+                    # Each selected sheet becomes its own source
+                    sheet_dfs = read_xlsx(path, usecols, ask_sheets=True)
+                    for fname, df in xlsx_sources(path, sheet_dfs):
+                        dfs.append(df)
+                        file_names.append(fname)
+                        print(f"✓ Loaded: {fname} ({len(df)} rows, {len(df.columns)} columns)")
+                    file_count += 1
+                    continue
                 df = read_file(path)
                 dfs.append(df)
                 # Generate file name
@@ -172,10 +369,16 @@ def load_files():
             print(f"\n✗ No CSV or Excel files found in '{INPUT_DIR}' folder!")
             return [], []
         for file in files:
-            df = read_file(os.path.join(INPUT_DIR, file))
-            dfs.append(df)
-            file_names.append(file)
-            print(f"✓ Loaded: {file} ({len(df)} rows, {len(df.columns)} columns)")
+            path = os.path.join(INPUT_DIR, file)
+            if file.endswith(".xlsx"):
+                # Read all sheets, each one as its own source
+                sources = xlsx_sources(file, read_xlsx(path, usecols))
+            else:
+                sources = [(file, read_file(path))]
+            for fname, df in sources:
+                dfs.append(df)
+                file_names.append(fname)
+                print(f"✓ Loaded: {fname} ({len(df)} rows, {len(df.columns)} columns)")
 
     return dfs, file_names
 
@@ -191,8 +394,43 @@ choice = input("\nSelect option: ").strip()
 if choice == "3":
     exit()
 
+# ---------------- SELECT TEMPLATE ----------------
+template_unique_cols = []  # Store unique column settings from template
+needed_cols = None  # Input columns the template reads (None = read all)
+
+if choice == "1":
+    templates = [f for f in os.listdir(TEMPLATE_DIR) if f.endswith('.json')]
+    if not templates:
+        print("\n✗ No templates found in templates folder!")
+        print("Please create a template first using option 2.")
+        exit()
+    
+    print("\n" + "="*50)
+    print("AVAILABLE TEMPLATES")
+    print("="*50)
+    for i, t in enumerate(templates, 1):
+        print(f"{i}. {t}")
+    print("="*50)
+    
+    tsel = int(input("\nSelect template number: "))
+    template_path = os.path.join(TEMPLATE_DIR, templates[tsel - 1])
+    
+    with open(template_path) as f:
+        template_data = json.load(f)
+    
+    # Check if template has unique settings
+    if isinstance(template_data, dict) and "columns" in template_data:
+        template = template_data["columns"]
+        template_unique_cols = template_data.get("unique_columns", [])
+    else:
+        template = template_data
+        template_unique_cols = []
+    
+    print(f"\n✓ Template loaded: {templates[tsel - 1]}")
+    needed_cols = set(template_columns(template))
+
 # ---------------- LOAD INPUT FILES ----------------
-dfs, file_names = load_files()
+dfs, file_names = load_files(needed_cols)
 
 if not dfs:
     print("\n✗ No files loaded. Exiting.")
@@ -274,38 +512,7 @@ if choice == "2":
     print()
 
 # ---------------- TEMPLATE ----------------
-template_unique_cols = []  # Store unique column settings from template
-
 if choice == "1":
-    templates = [f for f in os.listdir(TEMPLATE_DIR) if f.endswith('.json')]
-    if not templates:
-        print("\n✗ No templates found in templates folder!")
-        print("Please create a template first using option 2.")
-        exit()
-    
-    print("\n" + "="*50)
-    print("AVAILABLE TEMPLATES")
-    print("="*50)
-    for i, t in enumerate(templates, 1):
-        print(f"{i}. {t}")
-    print("="*50)
-    
-    tsel = int(input("\nSelect template number: "))
-    template_path = os.path.join(TEMPLATE_DIR, templates[tsel - 1])
-    
-    with open(template_path) as f:
-        template_data = json.load(f)
-    
-    # Check if template has unique settings
-    if isinstance(template_data, dict) and "columns" in template_data:
-        template = template_data["columns"]
-        template_unique_cols = template_data.get("unique_columns", [])
-    else:
-        template = template_data
-        template_unique_cols = []
-    
-    print(f"\n✓ Template loaded: {templates[tsel - 1]}")
-    
     # Ask for Quick Complete or Advanced mode
     print("\n" + "="*50)
     print("PROCESSING MODE")
@@ -321,29 +528,7 @@ if choice == "1":
         print("  → Auto-removing duplicates and blanks")
     
     # Validate template columns
-    missing_cols = []
-    for rule in template:
-        tokens = rule[1:]
-        # Remove dict if present
-        if isinstance(tokens[-1], dict):
-            tokens = tokens[:-1]
-        # Remove alignment codes
-        tokens = [t for t in tokens if t not in ALIGN_CODES]
-        
-        for token in tokens:
-            # Skip format codes and "0"
-            if token in FORMAT_CODES or token == "0":
-                continue
-            # Check if it's a column list
-            if token.startswith("[") and token.endswith("]"):
-                cols = token.strip("[]").split(",")
-                for col_name in cols:
-                    col_name = col_name.strip()
-                    if col_name not in column_list:
-                        missing_cols.append(col_name)
-            # Single column
-            elif token not in column_list:
-                missing_cols.append(token)
+    missing_cols = [c for c in template_columns(template) if c not in column_list]
     
     if missing_cols:
         print("\n" + "="*50)
@@ -491,6 +676,7 @@ print("\n⚙ Processing data...")
 
 output = {}
 column_alignments = {}
+source_cache = {}  # source token -> (codes, uniques), shared across rules
 
 for rule in template:
     col_name = rule[0]
@@ -514,49 +700,19 @@ for rule in template:
     if tokens and tokens[0] in FORMAT_CODES:
         tokens = ["0"] + tokens
 
-    values = []
-
-    for _, row in merged.iterrows():
-        val = ""
-        ptr = 0
-
-        if not tokens or tokens[0] == "0":
-            val = ""
-        elif tokens[0].startswith("["):
-            # Multiple columns
-            col_names = tokens[0].strip("[]").split(",")
-            raw = []
-            for cn in col_names:
-                cn = cn.strip()
-                if cn in merged.columns and str(row[cn]).strip():
-                    raw.append(str(row[cn]).strip())
-            val = " ".join(dict.fromkeys(raw))
-            ptr = 1
-        else:
-            # Single column
-            col_name_token = tokens[0]
-            if col_name_token in merged.columns:
-                val = row[col_name_token]
-            ptr = 1
-
-        # Apply format codes
-        for t in tokens[ptr:]:
-            if t not in ["k", "q"]:
-                val = apply_format(val, t)
-
-        # Apply dictionary lookup (k or q)
-        if ("k" in tokens or "q" in tokens) and col_dict:
-            matches = [v for k, v in col_dict.items() if k != "__default__" and k in str(val).lower()]
-            if matches:
-                val = ", ".join(dict.fromkeys(matches))
-            elif "q" in tokens and "__default__" in col_dict:
-                # Use default value if no match found
-                val = col_dict["__default__"]
-            elif "k" in tokens:
-                # For regular k, leave empty if no match
-                val = ""
+    # Factorize the source once, evaluate each distinct value, broadcast back
+    source = tokens[0] if tokens else "0"
+    if source not in source_cache:
+        source_cache[source] = factorize_source(merged, source)
+    codes, uniques = source_cache[source]
+
+    chain = tuple(t for t in tokens[1:] if t not in ["k", "q"])
+    lookup = tuple(t for t in ["k", "q"] if t in tokens)
+    evaluate = chain_evaluator(chain, lookup, tuple(col_dict.items()))
 
-        values.append(val)
+    results = np.empty(len(uniques), dtype=object)
+    results[:] = [evaluate(u) for u in uniques]
+    values = results[codes].tolist()
 
     output[col_name] = values
     column_alignments[col_name] = align